@@ -60,7 +60,6 @@ import logging
 import termios
 import threading
 import subprocess
-import zlib
 import shutil
 import select
 import hashlib
@@ -71,9 +70,25 @@ import pyperclip
 from time import sleep, monotonic
 from base64 import standard_b64encode
 from operator import attrgetter
-from collections import namedtuple
-from math import ceil
-from tempfile import NamedTemporaryFile
+from collections import OrderedDict
+from bisect import bisect_right
+from itertools import accumulate
+
+# prefer a SIMD-accelerated deflate if one is installed; both are
+# drop-in replacements for the stdlib module
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    try:
+        from zlib_ng import zlib_ng as zlib
+    except ImportError:
+        import zlib
+
+# numpy is optional; without it, tinting is unavailable
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 # Class Definitions
@@ -94,9 +109,17 @@ class Config:
             'elinks',
             'lynx'
         ]
+        # these need the terminal, so the viewer waits for them to exit
+        self.TERMINAL_BROWSERS = {'w3m', 'elinks', 'lynx'}
         self.URL_BROWSER = None
         self.GUI_VIEWER = 'preview'
         self.NOTE_PATH = os.path.join(os.getenv("HOME"), 'inbox.org')
+        # compress page images before sending them to kitty; turning
+        # this off saves CPU time when the terminal is local
+        self.COMPRESS = True
+        # bytes of decoded fonts and images MuPDF may keep around; this
+        # can only lower MuPDF's own limit of 256 MiB
+        self.STORE_MAXSIZE = 64 * 1024 * 1024
 
     def browser_detect(self):
         if sys.platform == 'darwin':
@@ -148,6 +171,8 @@ class Screen:
         self.cell_width = 0
         self.cell_height = 0
         self.stdscr = None
+        # escape codes for cursor positions, built as they are needed
+        self.cursor_codes = {}
 
     def get_size(self):
         fd = sys.stdout
@@ -213,17 +238,33 @@ class Screen:
         return win, pad
 
     def swallow_keys(self):
+        # throw away pending input without waiting for more
+        curses.flushinp()
         self.stdscr.nodelay(True)
-        k = self.stdscr.getch()
-        end = monotonic() + 0.1
-        while monotonic() < end:
-            self.stdscr.getch()
+        self.stdscr.getch()
         self.stdscr.nodelay(False)
 
+    def skip_gr_reply(self):
+        # after an ESC, read past the rest of a kitty graphics reply that
+        # came too late to be read as one; returns whether there was one
+        self.stdscr.timeout(100)
+        try:
+            c = self.stdscr.getch()
+            if c != ord('_'):
+                if c != -1:
+                    curses.ungetch(c)
+                return False
+            prev = None
+            while c != -1 and not (prev == 27 and c == ord('\\')):
+                prev, c = c, self.stdscr.getch()
+            return True
+        finally:
+            self.stdscr.timeout(-1)
+
     def clear(self):
         sys.stdout.buffer.write('\033[2J'.encode('ascii'))
 
-    def set_cursor(self,c,r):
+    def cursor_code(self,c,r):
         if c > self.cols:
             c = self.cols
         elif c < 0:
@@ -232,7 +273,13 @@ class Screen:
             r = self.rows
         elif r < 0:
             r = 0
-        sys.stdout.buffer.write('\033[{};{}f'.format(r, c).encode('ascii'))
+        code = self.cursor_codes.get((r,c))
+        if code is None:
+            code = self.cursor_codes[(r,c)] = '\033[{};{}f'.format(r, c).encode('ascii')
+        return code
+
+    def set_cursor(self,c,r):
+        sys.stdout.buffer.write(self.cursor_code(c,r))
 
     def place_string(self,c,r,string):
         self.set_cursor(c,r)
@@ -257,6 +304,34 @@ def get_cachefile(path):
     cachefile = os.path.join(cachedir, filehash)
     return cachefile
 
+def open_url(url):
+    if os.path.basename(config.URL_BROWSER) in config.TERMINAL_BROWSERS:
+        # a terminal browser takes over the tty until it exits
+        subprocess.run([config.URL_BROWSER, url], check=True)
+    else:
+        # don't wait for a GUI browser, and keep its output off the display
+        subprocess.Popen([config.URL_BROWSER, url],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+
+def words_in_rect(words, bb, rect, intersecting=False):
+    # select the words whose boxes lie inside (or intersect) rect,
+    # testing all the boxes at once when numpy is available; bb holds
+    # the word boxes as an (N, 4) array, or None to test them one by one
+    if bb is None:
+        if intersecting:
+            return [w for w in words if fitz.Rect(w[:4]).intersects(rect)]
+        return [w for w in words if fitz.Rect(w[:4]) in rect]
+    if intersecting:
+        # like fitz's Rect.intersects, an empty box intersects nothing
+        mask = ((bb[:,0] < rect.x1) & (bb[:,2] > rect.x0)
+                & (bb[:,1] < rect.y1) & (bb[:,3] > rect.y0)
+                & (bb[:,2] > bb[:,0]) & (bb[:,3] > bb[:,1]))
+    else:
+        mask = ((bb[:,0] >= rect.x0) & (bb[:,1] >= rect.y0)
+                & (bb[:,2] <= rect.x1) & (bb[:,3] <= rect.y1))
+    return [words[i] for i in np.flatnonzero(mask)]
+
 class Document(fitz.Document):
     """
     An extension of the fitz.Document class, with extra attributes
@@ -285,9 +360,28 @@ class Document(fitz.Document):
         self.invert = False
         self.tint = False
         self.tint_color = config.TINT_COLOR
+        self.tint_rgb = [int(c * 256) for c in fitz.utils.getColor(self.tint_color)]
         self.nvim = None
         self.nvim_listen_address = '/tmp/termpdf_nvim_bridge'
         self.page_states = [ Page_State(i) for i in range(0,self.pages + 1) ]
+        self.render_version = 0
+        # rendered pixmaps, most recently used last
+        self.pix_cache = OrderedDict()
+        self.pix_cache_size = 6
+        # what prefetch_page last found nothing left to do for
+        self.prefetched = None
+        # loaded pages and the parsed outline, both dropped on relayout
+        self.page_cache = OrderedDict()
+        self.page_cache_size = 8
+        self.word_cache = OrderedDict()
+        self.toc_cache = {}
+        self.chap_starts = None
+        # zoom and rotation matrices by (factor, rotation)
+        self.mat_cache = {}
+        # kitty image ids by page, least recently displayed first; kitty
+        # keeps every image it is sent, so only a few ids are handed out
+        self.kitty_ids = OrderedDict()
+        self.kitty_ids_max = 32
 
     def write_state(self):
         cachefile = get_cachefile(self.filename)
@@ -331,6 +425,39 @@ class Document(fitz.Document):
     def prev_page(self, count=1):
         self.goto_page(self.page - count)
 
+    def get_toc(self, simple=True):
+        if simple not in self.toc_cache:
+            self.toc_cache[simple] = fitz.Document.get_toc(self, simple)
+        return self.toc_cache[simple]
+
+    def get_page(self, p):
+        if p in self.page_cache:
+            self.page_cache.move_to_end(p)
+        else:
+            self.page_cache[p] = self.load_page(p)
+            while len(self.page_cache) > self.page_cache_size:
+                self.page_cache.popitem(last=False)
+        return self.page_cache[p]
+
+    def get_words(self, p):
+        # the words on a page, along with their boxes as an array;
+        # word positions are relative to the crop, so that is part
+        # of the key
+        page = self.get_page(p)
+        key = (p, tuple(page.cropbox))
+        if key in self.word_cache:
+            self.word_cache.move_to_end(key)
+        else:
+            words = page.get_text_words()
+            if np is not None and words:
+                bb = np.array([w[:4] for w in words])
+            else:
+                bb = None
+            self.word_cache[key] = (words, bb)
+            while len(self.word_cache) > self.page_cache_size:
+                self.word_cache.popitem(last=False)
+        return self.word_cache[key]
+
     def goto_chap(self, n):
         toc = self.get_toc()
         if n > len(toc):
@@ -344,13 +471,15 @@ class Document(fitz.Document):
             self.goto_page(0)
 
     def current_chap(self):
-        toc = self.get_toc()
-        p = self.page
-        for i,ch in enumerate(toc):
-           cp = ch[2] - 1
-           if cp > p:
-               return i - 1
-        return len(toc)
+        if self.chap_starts is None:
+            # running maximum, so that entries without a page (-1) or
+            # out of order don't break the bisection
+            self.chap_starts = list(accumulate((ch[2] - 1 for ch in self.get_toc()), max))
+        # index of the first chapter starting after the current page
+        i = bisect_right(self.chap_starts, self.page)
+        if i < len(self.chap_starts):
+            return i - 1
+        return len(self.chap_starts)
 
     def next_chap(self, count=1):
         self.goto_chap(self.chapter + count)
@@ -395,20 +524,6 @@ class Document(fitz.Document):
             logging.debug("writing new pagelabels...")
             writer.write(self.filename)
 
-    # unused; using pdfrw instead
-    def parse_pagelabels_pure(self):
-        cat = self._getPDFroot()
-
-        cat_str = self._getXrefString(cat)
-        lines = cat_str.split('\n')
-        labels = []
-        for line in lines:
-            match = re.search('/PageLabels',line)
-            if re.match(r'.*/PageLabels.*', line):
-                labels += [line]
-        logging.debug(labels)
-        raise SystemExit
-
     def pages_to_logical_pages(self):
         labels = self.parse_pagelabels()
         self.logical_pages = list(range(0,self.pages + 1))
@@ -506,6 +621,15 @@ class Document(fitz.Document):
         p = sizes[papersize]
         self.layout(fitz.paper_rect(p))
         self.pages = self.page_count - 1
+        # the pages may have changed, so start their state afresh
+        self.page_states = [ Page_State(i) for i in range(0,self.pages + 1) ]
+        self.pix_cache.clear()
+        self.page_cache.clear()
+        self.word_cache.clear()
+        self.toc_cache.clear()
+        self.chap_starts = None
+        self.mat_cache.clear()
+        self.prefetched = None
         if adjustpage:
             target = int((self.pages + 1) * pct) - 1
             target = self.find_target(target, target_text)
@@ -514,10 +638,29 @@ class Document(fitz.Document):
         self.pages_to_logical_pages()
 
     def mark_all_pages_stale(self):
-        self.page_states = [ Page_State(i) for i in range(0,self.pages + 1) ]
+        # bumping the version changes every page's render key, so each
+        # page is re-rendered when next displayed
+        self.render_version += 1
+        self.pix_cache.clear()
+
+    def kitty_id(self, p):
+        if p in self.kitty_ids:
+            self.kitty_ids.move_to_end(p)
+            return self.kitty_ids[p]
+        if len(self.kitty_ids) < self.kitty_ids_max:
+            i = len(self.kitty_ids) + 1
+        else:
+            # take over the id of the least recently displayed page,
+            # and have kitty free its image
+            old, i = self.kitty_ids.popitem(last=False)
+            write_gr_cmd({'a': 'd', 'd': 'I', 'i': i, 'q': 2})
+            if old < len(self.page_states):
+                self.page_states[old].rendered_key = None
+        self.kitty_ids[p] = i
+        return i
 
     def clear_page(self, p):
-        cmd = {'a': 'd', 'd': 'a', 'i': p + 1}
+        cmd = {'a': 'd', 'd': 'a', 'i': p + 1, 'q': 2}
         write_gr_cmd(cmd)
 
     def cells_to_pixels(self, *coords):
@@ -550,9 +693,8 @@ class Document(fitz.Document):
     def get_text_in_Rect(self, rect):
         from operator import itemgetter
         from itertools import groupby
-        page = self.load_page(self.page)
-        words = page.get_text_words()
-        mywords = [w for w in words if fitz.Rect(w[:4]) in rect]
+        words, bb = self.get_words(self.page)
+        mywords = words_in_rect(words, bb, rect)
         mywords.sort(key=itemgetter(3, 0))  # sort by y1, x0 of the word rect
         group = groupby(mywords, key=itemgetter(3))
         text = [] 
@@ -564,9 +706,8 @@ class Document(fitz.Document):
     def get_text_intersecting_Rect(self, rect):
         from operator import itemgetter
         from itertools import groupby
-        page = self.load_page(self.page)
-        words = page.get_text_words()
-        mywords = [w for w in words if fitz.Rect(w[:4]).intersects(rect)]
+        words, bb = self.get_words(self.page)
+        mywords = words_in_rect(words, bb, rect, intersecting=True)
         mywords.sort(key=itemgetter(3, 0))  # sort by y1, x0 of the word rect
         group = groupby(mywords, key=itemgetter(3))
         text = [] 
@@ -596,21 +737,26 @@ class Document(fitz.Document):
 
         return crop
 
-    def display_page(self, bar, p, display=True):
-
-        page = self.load_page(p)
+    def prepare_page(self, p):
+        page = self.get_page(p)
         page_state = self.page_states[p]
 
-        if self.manualcrop and self.manualcroprect != [None,None] and self.is_pdf:
-            page.set_cropbox(fitz.Rect(self.manualcroprect[0],self.manualcroprect[1]))
-
-        elif self.autocrop and self.is_pdf:
-            page.set_cropbox(page.mediabox)
-            crop = self.auto_crop(page)
-            page.set_cropbox(crop)
-
-        elif self.is_pdf:
-            page.set_cropbox(page.mediabox)
+        if self.is_pdf:
+            if self.manualcrop and self.manualcroprect != [None,None]:
+                crop = fitz.Rect(self.manualcroprect[0],self.manualcroprect[1])
+            elif self.autocrop:
+                # finding the margins parses the whole page, so only
+                # do it once per page
+                if page_state.crop is None:
+                    page.set_cropbox(page.mediabox)
+                    page_state.cropbox = page.mediabox
+                    page_state.crop = self.auto_crop(page)
+                crop = page_state.crop
+            else:
+                crop = page.mediabox
+            if page_state.cropbox != crop:
+                page.set_cropbox(crop)
+                page_state.cropbox = crop
 
         dw = scr.width
         dh = scr.height - scr.cell_height
@@ -626,7 +772,109 @@ class Document(fitz.Document):
         fx = dw / pw
         fy = dh / ph
         factor = min(fx,fy)
+
+        return page, factor, pw, ph
+
+    def render_key(self, page, factor):
+        # everything that affects how a page is rendered
+        # page.rect only has the crop's size, so key on the cropbox itself
+        return (page.number, factor, tuple(page.cropbox), self.rotation,
+                self.alpha, self.invert, self.tint, self.render_version)
+
+    def render_page(self, page, factor):
+        key = self.render_key(page, factor)
+        if key in self.pix_cache:
+            self.pix_cache.move_to_end(key)
+            return self.pix_cache[key]
+
+        # get zoomed and rotated pixmap
+        mat = self.mat_cache.get((factor, self.rotation))
+        if mat is None:
+            mat = fitz.Matrix(factor, factor)
+            mat = mat.prerotate(self.rotation)
+            self.mat_cache[(factor, self.rotation)] = mat
+        pix = page.get_pixmap(matrix = mat, alpha=self.alpha)
+
+        # an alpha channel on a fully opaque page is just dead weight:
+        # drop it and send 24-bit RGB, a quarter fewer bytes. Look at the
+        # alpha plane through samples_mv, which doesn't copy the pixmap.
+        if pix.alpha:
+            if np is not None:
+                opaque = np.frombuffer(pix.samples_mv, dtype=np.uint8)[pix.n - 1::pix.n].min() == 255
+            else:
+                opaque = not bytes(pix.samples_mv[pix.n - 1::pix.n]).strip(b'\xff')
+            if opaque:
+                pix = fitz.Pixmap(pix, 0)
+
+        if np is not None and (self.invert or self.tint):
+            # work on the color channels directly, leaving alpha alone
+            # samples_mv is a view of the pixmap; copy it once into a
+            # writable array
+            a = np.array(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+            rgb = a[..., :3]
+            if self.invert:
+                np.bitwise_xor(rgb, 0xff, out=rgb)
+            if self.tint:
+                rgb[...] = rgb.astype(np.uint16) * np.array(self.tint_rgb, dtype=np.uint16) // 256
+            samples = a.reshape(-1).data
+        else:
+            if self.invert:
+                pix.invert_irect()
+            samples = pix.samples_mv
+
+        # build cmd to send to kitty; the image is encoded here rather
+        # than when it is sent, so a cached page is ready to go as is
+        cmd = {'t': 'd', 's': pix.width, 'v': pix.height}
+
+        if pix.alpha:
+            cmd['f'] = 32
+        else:
+            cmd['f'] = 24
+
+        rendered = (cmd, *chunk_payload(encode_payload(cmd, samples)))
+        self.pix_cache[key] = rendered
+        while len(self.pix_cache) > self.pix_cache_size:
+            self.pix_cache.popitem(last=False)
+
+        # MuPDF's store otherwise grows with every image-heavy page;
+        # evict down to 80% of the limit once it is exceeded
+        # store_size is a property on classic PyMuPDF, but a method on the
+        # rebased one, which can't report the size and returns None
+        store_size = fitz.TOOLS.store_size
+        if callable(store_size):
+            store_size = store_size()
+        if isinstance(store_size, int) and store_size > config.STORE_MAXSIZE:
+            fitz.TOOLS.store_shrink(int(100 - 80 * config.STORE_MAXSIZE / store_size))
+
+        return rendered
+
+    def prefetch_page(self):
+        # render one neighbour of the current page that is neither cached
+        # nor already held by kitty, so that it is ready by the time the
+        # reader turns to it. Once both are ready, there is nothing to do
+        # until the page or a render setting changes.
+        state = (self.page, self.render_version, self.rotation, self.alpha,
+                 self.invert, self.tint, self.autocrop, self.manualcrop,
+                 scr.width, scr.height)
+        if state == self.prefetched:
+            return
+        for p in [self.page + 1, self.page - 1]:
+            if 0 <= p <= self.pages:
+                page, factor, _, _ = self.prepare_page(p)
+                key = self.render_key(page, factor)
+                if key != self.page_states[p].rendered_key and key not in self.pix_cache:
+                    self.render_page(page, factor)
+                    return
+        self.prefetched = state
+
+    def display_page(self, bar, p, display=True):
+
+        page, factor, pw, ph = self.prepare_page(p)
+        page_state = self.page_states[p]
         self.page_states[p].factor = factor
+
+        dw = scr.width
+        dh = scr.height - scr.cell_height
     
         # calculate zoomed dimensions
         zw = factor * pw
@@ -647,50 +895,30 @@ class Document(fitz.Document):
 
         # clear previous page
         # display image
-        cmd = {'a': 'p', 'i': p + 1, 'z': -1}
-        if page_state.stale: #or (display and not write_gr_cmd_with_response(cmd)):
-            # get zoomed and rotated pixmap
-            mat = fitz.Matrix(factor, factor)
-            mat = mat.prerotate(self.rotation)
-            pix = page.get_pixmap(matrix = mat, alpha=self.alpha)
-
-            if self.invert:
-                pix.invert_irect()
+        i = self.kitty_id(p)
+        cmd = {'a': 'p', 'i': i, 'z': -1}
+        key = self.render_key(page, factor)
+        if page_state.rendered_key != key: #or (display and not write_gr_cmd_with_response(cmd)):
+            cmd, head, tail = self.render_page(page, factor)
 
-            if self.tint:
-                tint = fitz.utils.getColor(self.tint_color)
-                red = int(tint[0] * 256)
-                blue = int(tint[1] * 256)
-                green = int(tint[2] * 256)
-                # pix.tint_with(red, blue, green)
-                # tinting disabled due to unresolved bug
-
-            # build cmd to send to kitty
-            cmd = {'i': p + 1, 't': 'd', 's': pix.width, 'v': pix.height}
-
-            if self.alpha:
-                cmd['f'] = 32
-            else:
-                cmd['f'] = 24
-
-            # transfer the image
-            write_chunked(cmd, pix.samples)
+            # transfer the image; kitty's reply would only end up as
+            # input, and the placement below reports any failure
+            write_chunked(dict(cmd, i=i, q=2), head, tail)
+            page_state.rendered_key = key
 
         if display:  
             # clear prevpage
             self.clear_page(self.prevpage)
             # display the image
-            cmd = {'a': 'p', 'i': p + 1, 'z': -1}
-            success = write_gr_cmd_with_response(cmd)
+            cmd = {'a': 'p', 'i': i, 'z': -1}
+            # kitty answers only once it has taken in the upload above,
+            # which can take a while over a slow link
+            success = write_gr_cmd_with_response(cmd, timeout=10)
             if not success:
-                self.page_states[p].stale = True
+                self.page_states[p].rendered_key = None
                 bar.message = 'failed to load page ' + str(p+1)
                 bar.update(self)
 
-        self.page_states[p].stale = False 
-
-        scr.swallow_keys()
-
     def show_toc(self, bar):
 
         toc = self.get_toc()
@@ -699,7 +927,7 @@ class Document(fitz.Document):
             bar.message = "No ToC available"
             return
 
-        self.page_states[self.page ].stale = True
+        self.page_states[self.page].rendered_key = None
         self.clear_page(self.page)
         scr.clear()
         
@@ -717,14 +945,19 @@ class Document(fitz.Document):
         win,pad,y,x,h,w,span = init_pad(toc)
 
         keys = shortcuts()
-        index = self.current_chap()
+        index = min(max(0, self.current_chap()), len(toc) - 1)
         j = 0
+        prev_index = None
        
         while True:
-            for i, ch in enumerate(toc):
-                attr = curses.A_REVERSE if index == i else curses.A_NORMAL
-                pad.chgat(i, 0, span[i], attr)
-            pad.refresh(j, 0, y + 3, x + 2, y + h - 2, x + w - 3)
+            # only the rows whose highlight changed need repainting
+            if index != prev_index:
+                if prev_index is not None:
+                    pad.chgat(prev_index, 0, span[prev_index], curses.A_NORMAL)
+                pad.chgat(index, 0, span[index], curses.A_REVERSE)
+                prev_index = index
+            pad.noutrefresh(j, 0, y + 3, x + 2, y + h - 2, x + w - 3)
+            curses.doupdate()
             key = scr.stdscr.getch()
             
             if key in keys.REFRESH:
@@ -733,7 +966,8 @@ class Document(fitz.Document):
                 scr.init_curses()
                 self.set_layout(self.papersize)
                 self.mark_all_pages_stale()
-                init_pad(toc)
+                win,pad,y,x,h,w,span = init_pad(toc)
+                prev_index = None
             elif key in keys.QUIT:
                 clean_exit()
             elif key == 27 or key in keys.SHOW_TOC:
@@ -797,7 +1031,7 @@ class Document(fitz.Document):
             bar.message = "No metadata available"
             return
 
-        self.page_states[self.page].stale = True
+        self.page_states[self.page].rendered_key = None
         self.clear_page(self.page)
         scr.clear()
         
@@ -817,12 +1051,17 @@ class Document(fitz.Document):
         keys = shortcuts()
         index = 0
         j = 0
+        prev_index = None
        
         while True:
-            for i, mkey in enumerate(meta):
-                attr = curses.A_REVERSE if index == i else curses.A_NORMAL
-                pad.chgat(i, 0, span[i], attr)
-            pad.refresh(j, 0, y + 3, x + 2, y + h - 2, x + w - 3)
+            # only the rows whose highlight changed need repainting
+            if index != prev_index:
+                if prev_index is not None:
+                    pad.chgat(prev_index, 0, span[prev_index], curses.A_NORMAL)
+                pad.chgat(index, 0, span[index], curses.A_REVERSE)
+                prev_index = index
+            pad.noutrefresh(j, 0, y + 3, x + 2, y + h - 2, x + w - 3)
+            curses.doupdate()
             key = scr.stdscr.getch()
             
             if key in keys.REFRESH:
@@ -831,7 +1070,8 @@ class Document(fitz.Document):
                 scr.init_curses()
                 self.set_layout(self.papersize)
                 self.mark_all_pages_stale()
-                init_pad(meta)
+                win,pad,y,x,h,w,span = init_pad(meta)
+                prev_index = None
             elif key in keys.QUIT:
                 clean_exit()
             elif key == 27 or key in keys.SHOW_META:
@@ -845,6 +1085,7 @@ class Document(fitz.Document):
                 self.update_metadata_from_bibtex()
                 meta = self.metadata
                 win,pad,y,x,h,w,span = init_pad(meta)
+                prev_index = None
             elif key in keys.OPEN:
                 # TODO edit metadata 
                 pass
@@ -866,7 +1107,7 @@ class Document(fitz.Document):
         elif kind == 1:
             self.goto_page(link['page'])
         elif kind == 2:
-            subprocess.run([config.URL_BROWSER, link['uri']], check=True)
+            open_url(link['uri'])
         elif kind == 3:
             # not sure what these are
             pass
@@ -878,7 +1119,7 @@ class Document(fitz.Document):
 
     def show_links(self, bar):
 
-        links = self[self.page].get_links()
+        links = self.get_page(self.page).get_links()
 
         urls = [link for link in links if 0 < link['kind'] < 3]
 
@@ -886,7 +1127,7 @@ class Document(fitz.Document):
             bar.message = "No links on page"
             return
 
-        self.page_states[self.page].stale = True
+        self.page_states[self.page].rendered_key = None
         self.clear_page(self.page)
         scr.clear()
         
@@ -916,12 +1157,17 @@ class Document(fitz.Document):
         keys = shortcuts()
         index = 0
         j = 0
+        prev_index = None
        
         while True:
-            for i, url in enumerate(urls):
-                attr = curses.A_REVERSE if index == i else curses.A_NORMAL
-                pad.chgat(i, 0, span[i], attr)
-            pad.refresh(j, 0, y + 3, x + 2, y + h - 2, x + w - 3)
+            # only the rows whose highlight changed need repainting
+            if index != prev_index:
+                if prev_index is not None:
+                    pad.chgat(prev_index, 0, span[prev_index], curses.A_NORMAL)
+                pad.chgat(index, 0, span[index], curses.A_REVERSE)
+                prev_index = index
+            pad.noutrefresh(j, 0, y + 3, x + 2, y + h - 2, x + w - 3)
+            curses.doupdate()
             key = scr.stdscr.getch()
             
             if key in keys.REFRESH:
@@ -930,7 +1176,8 @@ class Document(fitz.Document):
                 scr.init_curses()
                 self.set_layout(self.papersize)
                 self.mark_all_pages_stale()
-                init_pad(urls)
+                win,pad,y,x,h,w,span = init_pad(urls)
+                prev_index = None
             elif key in keys.QUIT:
                 clean_exit()
             elif key == 27 or key in keys.SHOW_LINKS:
@@ -996,10 +1243,13 @@ class Document(fitz.Document):
 class Page_State:
     def __init__(self, p):
         self.number = p
-        self.stale = True
+        # render_key of the image kitty currently holds for this page
+        self.rendered_key = None
         self.factor = (1,1)
         self.place = (0,0,40,40)
         self.crop = None
+        # cropbox currently set on the page
+        self.cropbox = None
 
 class status_bar:
 
@@ -1011,58 +1261,69 @@ class status_bar:
         self.counter = ' '
         self.format = '{} {:^{me_w}} {}'
         self.bar = ''
+        # self.bar, encoded and prefixed with the cursor move to the last row
+        self.bar_bytes = b''
+        # what self.bar was last built from
+        self.last_key = None
 
     def update(self, doc):
         p = doc.page_to_logical()
         pc = doc.page_to_logical(doc.pages)
-        self.counter = '[{}/{}]'.format(p, pc)
-        w = self.cols = scr.cols
-        cm_w = len(self.cmd)
-        co_w = len(self.counter)
-        me_w = w - cm_w - co_w - 2
-        if len(self.message) > me_w:
-            self.message = self.message[:me_w - 1] + '…' 
-        self.bar = self.format.format(self.cmd, self.message, self.counter, me_w=me_w)
-        scr.place_string(1,scr.rows,self.bar)
+        if (p, pc, scr.cols, scr.rows, self.cmd, self.message) != self.last_key:
+            self.counter = '[{}/{}]'.format(p, pc)
+            w = self.cols = scr.cols
+            cm_w = len(self.cmd)
+            co_w = len(self.counter)
+            me_w = w - cm_w - co_w - 2
+            if len(self.message) > me_w:
+                self.message = self.message[:me_w - 1] + '…' 
+            self.bar = self.format.format(self.cmd, self.message, self.counter, me_w=me_w)
+            self.bar_bytes = scr.cursor_code(1, scr.rows) + self.bar.encode()
+            self.last_key = (p, pc, scr.cols, scr.rows, self.cmd, self.message)
+        write_bytes(self.bar_bytes)
 
 class shortcuts:
 
     def __init__(self):
-        self.GOTO_PAGE        = [ord('G')]
-        self.GOTO             = [ord('g')]
-        self.NEXT_PAGE        = [ord('j'), curses.KEY_DOWN, ord(' ')]
-        self.PREV_PAGE        = [ord('k'), curses.KEY_UP]
-        self.GO_BACK          = [ord('p')]
-        self.NEXT_CHAP        = [ord('l'), curses.KEY_RIGHT]
-        self.PREV_CHAP        = [ord('h'), curses.KEY_LEFT]
-        self.BUFFER_CYCLE     = [ord('b')]
-        self.BUFFER_CYCLE_REV = [ord('B')]
-        self.HINTS            = [ord('f')]
-        self.OPEN             = [curses.KEY_ENTER, curses.KEY_RIGHT, 10]
-        self.SHOW_TOC         = [ord('t')]
-        self.SHOW_META        = [ord('M')]
-        self.UPDATE_FROM_BIB  = [ord('b')]
-        self.SHOW_LINKS       = [ord('f')]
-        self.TOGGLE_TEXT_MODE = [ord('T')]
-        self.ROTATE_CW        = [ord('r')]
-        self.ROTATE_CCW       = [ord('R')]
-        self.VISUAL_MODE      = [ord('s')]
-        self.SELECT           = [ord('v')]
-        self.YANK             = [ord('y')]
-        self.INSERT_NOTE      = [ord('n')]
-        self.APPEND_NOTE      = [ord('a')]
-        self.TOGGLE_AUTOCROP  = [ord('c')]
-        self.TOGGLE_ALPHA     = [ord('A')]
-        self.TOGGLE_INVERT    = [ord('i')]
-        self.TOGGLE_TINT      = [ord('d')]
-        self.SET_PAGE_LABEL   = [ord('P')]
-        self.SET_PAGE_ALT     = [ord('I')]
-        self.INC_FONT         = [ord('=')]
-        self.DEC_FONT         = [ord('-')]
-        self.OPEN_GUI         = [ord('X')]
-        self.REFRESH          = [18, curses.KEY_RESIZE]            # CTRL-R
-        self.QUIT             = [3, ord('q')]
-        self.DEBUG            = [ord('D')]
+        self.GOTO_PAGE        = frozenset([ord('G')])
+        self.GOTO             = frozenset([ord('g')])
+        self.NEXT_PAGE        = frozenset([ord('j'), curses.KEY_DOWN, ord(' ')])
+        self.PREV_PAGE        = frozenset([ord('k'), curses.KEY_UP])
+        self.GO_BACK          = frozenset([ord('p')])
+        self.NEXT_CHAP        = frozenset([ord('l'), curses.KEY_RIGHT])
+        self.PREV_CHAP        = frozenset([ord('h'), curses.KEY_LEFT])
+        self.NARROW_RIGHT     = frozenset([ord('L'), curses.KEY_SRIGHT])
+        self.NARROW_LEFT      = frozenset([ord('H'), curses.KEY_SLEFT])
+        self.BUFFER_CYCLE     = frozenset([ord('b')])
+        self.BUFFER_CYCLE_REV = frozenset([ord('B')])
+        self.BUFFER_CLOSE     = frozenset([ord('d')])
+        self.HINTS            = frozenset([ord('f')])
+        self.OPEN             = frozenset([curses.KEY_ENTER, curses.KEY_RIGHT, 10])
+        self.SHOW_TOC         = frozenset([ord('t')])
+        self.SHOW_META        = frozenset([ord('M')])
+        self.UPDATE_FROM_BIB  = frozenset([ord('b')])
+        self.SHOW_LINKS       = frozenset([ord('f')])
+        self.TOGGLE_TEXT_MODE = frozenset([ord('T')])
+        self.ROTATE_CW        = frozenset([ord('r')])
+        self.ROTATE_CCW       = frozenset([ord('R')])
+        self.VISUAL_MODE      = frozenset([ord('s')])
+        self.SELECT           = frozenset([ord('v')])
+        self.YANK             = frozenset([ord('y')])
+        self.INSERT_NOTE      = frozenset([ord('n')])
+        self.APPEND_NOTE      = frozenset([ord('a')])
+        self.TOGGLE_AUTOCROP  = frozenset([ord('c')])
+        self.TOGGLE_ALPHA     = frozenset([ord('A')])
+        self.TOGGLE_INVERT    = frozenset([ord('i')])
+        self.TOGGLE_TINT      = frozenset([ord('d')])
+        self.SET_PAGE_LABEL   = frozenset([ord('P')])
+        self.SET_PAGE_ALT     = frozenset([ord('I')])
+        self.INC_FONT         = frozenset([ord('=')])
+        self.DEC_FONT         = frozenset([ord('-')])
+        self.OPEN_GUI         = frozenset([ord('X')])
+        self.SEARCH           = frozenset([ord('/')])
+        self.REFRESH          = frozenset([18, curses.KEY_RESIZE])            # CTRL-R
+        self.QUIT             = frozenset([3, ord('q')])
+        self.DEBUG            = frozenset([ord('D')])
 
 # Kitty graphics functions
 
@@ -1084,29 +1345,71 @@ def write_gr_cmd(cmd, payload=None):
     sys.stdout.buffer.write(serialize_gr_command(cmd, payload))
     sys.stdout.flush()
 
-def write_gr_cmd_with_response(cmd, payload=None):
-    # rewrite using swallow keys to be nonblocking
+def write_gr_cmd_with_response(cmd, payload=None, timeout=0.5):
     write_gr_cmd(cmd, payload)
+    # read whatever the terminal has sent so far in one go, rather
+    # than a byte at a time, until kitty replies for this image; give
+    # up if it goes quiet for timeout seconds
+    want = 'i={}'.format(cmd['i']).encode('ascii')
+    fd = sys.stdin.fileno()
     resp = b''
-    while resp[-2:] != b'\033\\':
-        resp += sys.stdin.buffer.read(1)
-    if b'OK' in resp:
-        return True
-    else:
-        return False
+    replies = []
+    while not any(r.split(b';')[0].split(b',')[0] == want for r in replies):
+        r, _, _ = select.select([fd], [], [], timeout)
+        if not r:
+            break
+        resp += os.read(fd, 4096)
+        replies = re.findall(b'\033_G([^\033]*)\033\\\\', resp)
+    # anything else is keys typed in the meantime, once replies that
+    # came too late for an earlier command are dropped; hand them back
+    # to curses, which pushes each in front of the last. Its queue is
+    # short, so a long burst loses its oldest keys.
+    resp = re.sub(b'\033_G[^\033]*\033\\\\', b'', resp)
+    try:
+        for c in reversed(resp):
+            curses.ungetch(c)
+    except curses.error:
+        pass
+    return any(r.split(b';')[0].split(b',')[0] == want and r.endswith(b';OK')
+               for r in replies)
 
 
-def write_chunked(cmd, data):
-    if cmd['f'] != 100:
-        data = zlib.compress(data)
+def encode_payload(cmd, data):
+    if cmd['f'] != 100 and config.COMPRESS:
+        # kitty only cares that it inflates, not about the ratio
+        data = zlib.compress(data, 1)
         cmd['o'] = 'z'
-    data = standard_b64encode(data)
-    while data:
-        chunk, data = data[:4096], data[4096:]
-        m = 1 if data else 0
-        cmd['m'] = m
-        write_gr_cmd(cmd, chunk)
-        cmd.clear()
+    return standard_b64encode(data)
+
+def chunk_payload(data):
+    # data comes base64 encoded, from encode_payload; kitty wants it in
+    # chunks of at most 4096 bytes. Only the first chunk carries the
+    # command (and with it the image id), so everything after it is
+    # framed here once and can be resent under any id.
+    data = memoryview(data)
+    tail = bytearray()
+    pos = 4096
+    while pos < len(data):
+        chunk = data[pos:pos + 4096]
+        pos += 4096
+        m = 1 if pos < len(data) else 0
+        tail += serialize_gr_command({'m': m}, chunk)
+    return bytes(data[:4096]), bytes(tail)
+
+def write_chunked(cmd, head, tail):
+    cmd['m'] = 1 if tail else 0
+    write_bytes(serialize_gr_command(cmd, head), tail)
+
+def write_bytes(*bufs):
+    # write straight to the terminal rather than through python's
+    # text and buffer layers; flush first so anything already queued
+    # there (e.g. a cursor move) still comes before these bytes
+    sys.stdout.flush()
+    fd = sys.stdout.fileno()
+    for buf in bufs:
+        buf = memoryview(buf)
+        while buf:
+            buf = buf[os.write(fd, buf):]
 
 # bibtex functions
 
@@ -1235,7 +1538,7 @@ def parse_args(args):
             path = path_from_citekey(citekey)
             if path:
                 if path[-5:] == '.html':
-                    subprocess.run([config.URL_BROWSER, path], check=True)
+                    open_url(path)
                     print("Opening html file in browser")
                 elif path[-5:] == '.docx':
                     # TODO: support for docx files
@@ -1308,6 +1611,8 @@ def visual_mode(doc,bar):
     width = (r - l) + 1
 
     def highlight_row(row,left,right, fill='▒', color='yellow'):
+        # return the escape codes, so a whole selection can be
+        # drawn with a single write
         if color == 'yellow':
             cc = 33
         elif color == 'blue':
@@ -1317,25 +1622,28 @@ def visual_mode(doc,bar):
 
         fill = fill[0] * (right - left)
 
-        scr.set_cursor(l + left,row)
-        sys.stdout.buffer.write('\033[{}m'.format(cc).encode('ascii'))
-        #sys.stdout.buffer.write('\033[{}m'.format(cc + 10).encode('ascii'))
-        sys.stdout.write(fill)
-        sys.stdout.flush()
-        sys.stdout.buffer.write(b'\033[0m')
-        sys.stdout.flush()
+        code = scr.cursor_code(l + left,row)
+        code += '\033[{}m'.format(cc).encode('ascii')
+        #code += '\033[{}m'.format(cc + 10).encode('ascii')
+        code += fill.encode(sys.stdout.encoding)
+        code += b'\033[0m'
+        return code
 
     def unhighlight_row(row):
         # scr.set_cursor(l,row)
         # sys.stdout.write(' ' * width)
         # sys.stdout.flush()
-        highlight_row(row,0,width,fill=' ',color='none')
+        sys.stdout.buffer.write(highlight_row(row,0,width,fill=' ',color='none'))
+        sys.stdout.flush()
 
     def highlight_selection(selection,left,right, fill='▒', color='blue'):
         a = min(selection)
         b = max(selection)
+        buf = bytearray()
         for r in range(a,b+1):
-            highlight_row(r,left,right,fill,color)
+            buf += highlight_row(r,left,right,fill,color)
+        sys.stdout.buffer.write(buf)
+        sys.stdout.flush()
 
     def unhighlight_selection(selection):
         highlight_selection(selection,0,width,fill=' ',color='none')
@@ -1345,140 +1653,174 @@ def visual_mode(doc,bar):
     right = width
     select = False
     selection = [current_row,current_row]
-    count_string = '' 
+    # pending count, accumulated from digits as they are typed
+    pending_count = 0
+    has_count = False
 
-    while True:
-       
-        bar.cmd = count_string
-        bar.update(doc)
+    def ordered(selection):
+        top, bottom = selection
+        return [top, bottom] if top <= bottom else [bottom, top]
+
+    def clear_count():
+        nonlocal pending_count, has_count
+        pending_count = 0
+        has_count = False
+
+    # key handlers; a handler returns True to leave visual mode
+
+    def leave():
         unhighlight_selection([t,b])
+        return True
+
+    def toggle_select():
+        nonlocal select, selection
         if select:
-            highlight_selection(selection,left,right,color='blue')
+            select = False
         else:
-            highlight_selection(selection,left,right,color='yellow')
+            select = True
+        selection = [current_row, current_row]
+        clear_count()
 
-        if count_string == '':
-            count = 1
+    def move_to_row(row):
+        nonlocal current_row, selection
+        current_row = row
+        if select:
+            selection[1] = current_row
         else:
-            count = int(count_string)
+            selection = [current_row,current_row]
+        clear_count()
 
-        keys = shortcuts() 
-        key = scr.stdscr.getch()
-      
-        if key in range(48,58): #numerals
-            count_string = count_string + chr(key)
+    def next_row():
+        move_to_row(min(current_row + count,b))
 
-        elif key in keys.QUIT:
-            clean_exit()
+    def prev_row():
+        move_to_row(max(current_row - count,t))
 
-        elif key == 27 or key in keys.VISUAL_MODE:
-            unhighlight_selection([t,b])
-            return
+    def last_row():
+        move_to_row(b)
 
-        elif key in keys.SELECT:
-            if select:
-                select = False
-            else:
-                select = True
-            selection = [current_row, current_row]
-            count_string = ''
+    def first_row():
+        move_to_row(t)
 
-        elif key in keys.NEXT_PAGE:
-            current_row += count 
-            current_row = min(current_row,b)
-            if select:
-                selection[1] = current_row
-            else:
-                selection = [current_row,current_row]
-            count_string = ''
-
-        elif key in keys.PREV_PAGE:
-            current_row -= count 
-            current_row = max(current_row,t)
-            if select:
-                selection[1] = current_row
-            else:
-                selection = [current_row,current_row]
-            count_string = ''
-        
-        elif key in keys.NEXT_CHAP:
-            right = min(width,right + count)
-            count_string = ''
-
-        elif key in { ord('L'), curses.KEY_SRIGHT }:
-            right = max(left + 1,right - count)
-            count_string = ''
-
-        elif key in keys.PREV_CHAP:
-            left = max(0,left - count)
-            count_string = ''
-
-        elif key  in { ord('H'), curses.KEY_SLEFT }:
-            left = min(left + count,right - 1)
-            count_string = ''
-
-        elif key in keys.GOTO_PAGE:
-            current_row = b
-            if select:
-                selection[1] = current_row
-            else:
-                selection = [current_row,current_row]
-            count_string = ''
+    def widen_right():
+        nonlocal right
+        right = min(width,right + count)
+        clear_count()
 
-        elif key in keys.GOTO:
-            current_row = t
-            if select:
-                selection[1] = current_row
-            else:
-                selection = [current_row,current_row]
-            count_string = ''
-
-        elif key in keys.YANK:
-            if selection == [None,None]:
-                selection = [current_row, current_row]
-            selection.sort()
-            select_text = get_text_in_rows(doc,left,right,selection)
-            select_text = '> ' + select_text
-            pyperclip.copy(select_text)
-            unhighlight_selection([t,b])
-            bar.message = 'copied'
-            return
+    def narrow_right():
+        nonlocal right
+        right = max(left + 1,right - count)
+        clear_count()
 
-        elif key in keys.INSERT_NOTE:
-            if selection == [None,None]:
-                selection = [current_row, current_row]
-            selection.sort()
-            select_text = ['']
-            select_text = ['#+BEGIN_QUOTE']
-            select_text += [get_text_in_rows(doc,left,right,selection)]
-            select_text += ['#+END_QUOTE']
-            select_text += ['']
-            doc.send_to_neovim(select_text, append=False)
-            unhighlight_selection([t,b])
-            return
+    def widen_left():
+        nonlocal left
+        left = max(0,left - count)
+        clear_count()
 
-        elif key in keys.APPEND_NOTE:
-            if selection == [None,None]:
-                selection = [current_row, current_row]
-            selection.sort()
-            note_header = ' Notes on {}, {}'.format(doc.metadata['author'], doc.metadata['title'])
-            if doc.citekey:
-                note_header = doc.citekey + note_header
-            select_text = ['** ' + note_header] 
-            select_text += ['']
-            select_text = ['#+BEGIN_QUOTE']
-            select_text += [get_text_in_rows(doc,left,right,selection)]
-            select_text += ['#+END_QUOTE']
-            select_text += ['']
-            doc.send_to_neovim(select_text,append=True)
-            unhighlight_selection([t,b])
-            return
-        
-        elif key in keys.TOGGLE_AUTOCROP and selection != [None,None]:
+    def narrow_left():
+        nonlocal left
+        left = min(left + count,right - 1)
+        clear_count()
+
+    def yank():
+        nonlocal selection
+        if selection == [None,None]:
+            selection = [current_row, current_row]
+        selection = ordered(selection)
+        select_text = get_text_in_rows(doc,left,right,selection)
+        select_text = '> ' + select_text
+        pyperclip.copy(select_text)
+        unhighlight_selection([t,b])
+        bar.message = 'copied'
+        return True
+
+    def insert_note():
+        nonlocal selection
+        if selection == [None,None]:
+            selection = [current_row, current_row]
+        selection = ordered(selection)
+        select_text = ['']
+        select_text = ['#+BEGIN_QUOTE']
+        select_text += [get_text_in_rows(doc,left,right,selection)]
+        select_text += ['#+END_QUOTE']
+        select_text += ['']
+        doc.send_to_neovim(select_text, append=False)
+        unhighlight_selection([t,b])
+        return True
+
+    def append_note():
+        nonlocal selection
+        if selection == [None,None]:
+            selection = [current_row, current_row]
+        selection = ordered(selection)
+        note_header = ' Notes on {}, {}'.format(doc.metadata['author'], doc.metadata['title'])
+        if doc.citekey:
+            note_header = doc.citekey + note_header
+        select_text = ['** ' + note_header] 
+        select_text += ['']
+        select_text = ['#+BEGIN_QUOTE']
+        select_text += [get_text_in_rows(doc,left,right,selection)]
+        select_text += ['#+END_QUOTE']
+        select_text += ['']
+        doc.send_to_neovim(select_text,append=True)
+        unhighlight_selection([t,b])
+        return True
+
+    def crop():
+        if selection != [None,None]:
             crop_to_selection(doc,left,right,selection)
             unhighlight_selection([t,b])
             doc.mark_all_pages_stale()
-            return
+            return True
+
+    # map each key to its handler once, rather than testing the key
+    # against every shortcut on each keypress; where shortcuts share
+    # a key, the first one listed wins
+    keys = shortcuts() 
+    dispatch = {}
+    for shortcut, handler in [
+            (keys.QUIT, clean_exit),
+            ([27], leave),
+            (keys.VISUAL_MODE, leave),
+            (keys.SELECT, toggle_select),
+            (keys.NEXT_PAGE, next_row),
+            (keys.PREV_PAGE, prev_row),
+            (keys.NEXT_CHAP, widen_right),
+            (keys.NARROW_RIGHT, narrow_right),
+            (keys.PREV_CHAP, widen_left),
+            (keys.NARROW_LEFT, narrow_left),
+            (keys.GOTO_PAGE, last_row),
+            (keys.GOTO, first_row),
+            (keys.YANK, yank),
+            (keys.INSERT_NOTE, insert_note),
+            (keys.APPEND_NOTE, append_note),
+            (keys.TOGGLE_AUTOCROP, crop)]:
+        for k in shortcut:
+            dispatch.setdefault(k, handler)
+
+    getch = scr.stdscr.getch
+
+    while True:
+       
+        bar.cmd = str(pending_count) if has_count else ''
+        bar.update(doc)
+        unhighlight_selection([t,b])
+        if select:
+            highlight_selection(selection,left,right,color='blue')
+        else:
+            highlight_selection(selection,left,right,color='yellow')
+
+        count = pending_count if has_count else 1
+
+        key = getch()
+      
+        if 48 <= key < 58: #numerals
+            pending_count = pending_count * 10 + (key - 48)
+            has_count = True
+
+        elif key in dispatch:
+            if dispatch[key]():
+                return
 
 def watch_for_file_change(file_change,path):
     timestamp = os.path.getmtime(path)
@@ -1505,284 +1847,319 @@ def view(file_change,doc):
     if doc.citekey:
         bar.message = doc.citekey
 
-    count_string = ""
+    # pending count, accumulated from digits as they are typed
+    pending_count = 0
+    has_count = False
     stack = [0]
+    # the stack as shown in the status bar, oldest key first
+    stack_str = '\x00'
     keys = shortcuts() 
 
-    while True:
+    # key handlers
 
-        bar.cmd = ''.join(map(chr,stack[::-1]))
-        bar.update(doc )
-        doc.display_page(bar,doc.page)
+    def reset():
+        nonlocal pending_count, has_count, stack, stack_str
+        pending_count = 0
+        has_count = False
+        stack = [0]
+        stack_str = '\x00'
 
-        if count_string == "":
-            count = 1
+    def refresh():
+        nonlocal doc
+        scr.clear()
+        scr.get_size()
+        scr.init_curses()
+        current_doc = bufs.docs[bufs.current]
+        current_doc.write_state()
+        doc = Document(current_doc.filename)
+        cachefile = get_cachefile(doc.filename)
+        if os.path.exists(cachefile):
+            with open(cachefile, 'r') as f:
+                state = json.load(f)
+            for key in state:
+                setattr(doc, key, state[key])
+        bufs.docs[bufs.current] = doc
+        if not doc.citekey:
+            doc.citekey = citekey_from_path(doc.filename)
+        doc.pages_to_logical_pages()
+        doc.goto_logical_page(doc.logicalpage)
+        doc.set_layout(doc.papersize,adjustpage=False)
+
+    def switch_buffer():
+        nonlocal doc
+        doc = bufs.docs[bufs.current]
+        doc.goto_logical_page(doc.logicalpage)
+        doc.set_layout(doc.papersize,adjustpage=False)
+        doc.mark_all_pages_stale()
+        if doc.citekey:
+            bar.message = doc.citekey
+        reset()
+
+    def buffer_cycle_rev():
+        bufs.cycle(-count)
+        switch_buffer()
+
+    def goto_page():
+        if not has_count:
+            p = doc.page_to_logical(doc.pages)
         else:
-            count = int(count_string)
-        
+            p = count
+        doc.goto_logical_page(p)
+        reset()
+
+    def next_page():
+        doc.next_page(count)
+        reset()
+
+    def prev_page():
+        doc.prev_page(count)
+        reset()
+
+    def go_back():
+        doc.goto_page(doc.prevpage)
+        reset()
+
+    def next_chap():
+        doc.next_chap(count)
+        reset()
+
+    def prev_chap():
+        doc.prev_chap(count)
+        reset()
+
+    def rotate_cw():
+        doc.rotation = (doc.rotation + 90 * count) % 360
+        reset()
+
+    def rotate_ccw():
+        doc.rotation = (doc.rotation - 90 * count) % 360
+        reset()
+
+    def toggle_autocrop():
+        # cycle through no crop, autocrop, and manualcrop
+        if doc.manualcroprect != [None,None]:
+            if doc.autocrop:
+                doc.autocrop = False
+                doc.manualcrop = True
+            elif doc.manualcrop:
+                doc.autocrop = False
+                doc.manualcrop = False
+            else:
+                doc.autocrop = True
+        # just toggle autocrop
+        else:
+            doc.autocrop = not doc.autocrop
+        reset()
+
+    def toggle(attr):
+        # make a handler that flips a boolean setting of the document
+        def toggle_attr():
+            setattr(doc, attr, not getattr(doc, attr))
+            reset()
+        return toggle_attr
+
+    def show_toc():
+        doc.show_toc(bar)
+        reset()
+
+    def show_meta():
+        doc.show_meta(bar)
+        reset()
+
+    def show_links():
+        doc.show_links(bar)
+        reset()
+
+    def toggle_text_mode():
+        doc.view_text()
+        reset()
+
+    def inc_font():
+        doc.set_layout(doc.papersize - count)
+        doc.mark_all_pages_stale()
+        reset()
+
+    def dec_font():
+        doc.set_layout(doc.papersize + count)
+        doc.mark_all_pages_stale()
+        reset()
+
+    def visual():
+        visual_mode(doc,bar)
+        reset()
+
+    def insert_note():
+        text = doc.make_link()
+        doc.send_to_neovim(text,append=False)
+        reset()
+
+    def append_note():
+        text = doc.make_link()
+        doc.send_to_neovim(text,append=True)
+        reset()
+
+    def set_page_label():
+        if doc.is_pdf:
+            doc.set_pagelabel(count,'arabic')
+        else:
+            doc.first_page_offset = count - doc.page
+        doc.pages_to_logical_pages()
+        reset()
+
+    def set_page_alt():
+        nonlocal pending_count, has_count
+        if doc.is_pdf:
+            doc.set_pagelabel(count,'roman lowercase')
+        else:
+            doc.first_page_offset = count - doc.page
+        doc.pages_to_logical_pages()
+        pending_count = 0
+        has_count = False
+
+    def search():
+        scr.place_string(1,scr.rows,"/")
+        curses.echo()
+        scr.set_cursor(2,scr.rows)
+        s = scr.stdscr.getstr()
+        search_text = s.decode('utf-8')
+        curses.noecho()
+        bar.message = doc.search_text(search_text)
+
+    def open_gui():
+        subprocess.Popen([config.GUI_VIEWER, doc.filename],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+
+    def debug():
+        pass
+
+    # map each key to its handler once, rather than testing the key
+    # against every shortcut on each keypress; where shortcuts share
+    # a key, the first one listed wins
+    dispatch = {}
+    for shortcut, handler in [
+            (keys.REFRESH, refresh),
+            (keys.BUFFER_CYCLE_REV, buffer_cycle_rev),
+            (keys.QUIT, clean_exit),
+            (keys.GOTO_PAGE, goto_page),
+            (keys.NEXT_PAGE, next_page),
+            (keys.PREV_PAGE, prev_page),
+            (keys.GO_BACK, go_back),
+            (keys.NEXT_CHAP, next_chap),
+            (keys.PREV_CHAP, prev_chap),
+            (keys.ROTATE_CW, rotate_cw),
+            (keys.ROTATE_CCW, rotate_ccw),
+            (keys.TOGGLE_AUTOCROP, toggle_autocrop),
+            (keys.TOGGLE_ALPHA, toggle('alpha')),
+            (keys.TOGGLE_INVERT, toggle('invert')),
+            (keys.TOGGLE_TINT, toggle('tint')),
+            (keys.SHOW_TOC, show_toc),
+            (keys.SHOW_META, show_meta),
+            (keys.SHOW_LINKS, show_links),
+            (keys.TOGGLE_TEXT_MODE, toggle_text_mode),
+            (keys.INC_FONT, inc_font),
+            (keys.DEC_FONT, dec_font),
+            (keys.VISUAL_MODE, visual),
+            (keys.INSERT_NOTE, insert_note),
+            (keys.APPEND_NOTE, append_note),
+            (keys.SET_PAGE_LABEL, set_page_label),
+            (keys.SET_PAGE_ALT, set_page_alt),
+            (keys.SEARCH, search),
+            (keys.OPEN_GUI, open_gui),
+            (keys.DEBUG, debug)]:
+        for k in shortcut:
+            dispatch.setdefault(k, handler)
+
+    # whether the page needs displaying again; keys that only change
+    # the pending count or prefix leave it alone, but still need the
+    # status bar redrawn
+    dirty = True
+    dirty_bar = True
+
+    while True:
+
+        bar.cmd = stack_str
+        if dirty or dirty_bar:
+            bar.update(doc )
+            dirty_bar = False
+        if dirty:
+            doc.display_page(bar,doc.page)
+            dirty = False
+
+        # bound here rather than once, since refresh replaces stdscr
+        getch = scr.stdscr.getch
         scr.stdscr.nodelay(True)
         scr.stdscr.timeout(100)
 
-        key = scr.stdscr.getch()
+        key = getch()
         while key == -1 and not file_change.is_set():
-            key = scr.stdscr.getch()
+            # use idle time to render the neighbouring pages
+            doc.prefetch_page()
+            key = getch()
         scr.stdscr.nodelay(False)
 
         if file_change.is_set():
             logging.debug('view thread sees that file has changed')
-            key = keys.REFRESH[0]
+            key = next(iter(keys.REFRESH))
             file_change.clear()
 
-        if key == -1:
-            pass
-
-        elif key in keys.REFRESH: 
-            scr.clear()
-            scr.get_size()
-            scr.init_curses()
-            current_doc = bufs.docs[bufs.current]
-            current_doc.write_state()
-            doc = Document(current_doc.filename)
-            cachefile = get_cachefile(doc.filename)
-            if os.path.exists(cachefile):
-                with open(cachefile, 'r') as f:
-                    state = json.load(f)
-                for key in state:
-                    setattr(doc, key, state[key])
-            bufs.docs[bufs.current] = doc
-            if not doc.citekey:
-                doc.citekey = citekey_from_path(doc.filename)
-            doc.pages_to_logical_pages()
-            doc.goto_logical_page(doc.logicalpage)
-            doc.set_layout(doc.papersize,adjustpage=False)
-
-        elif key == 27:
-            # quash stray escape codes
-            scr.swallow_keys()
-            count_string = ""
-            stack = [0]
-
-        elif stack[0] in keys.BUFFER_CYCLE and key in range(48,58):
-            bufs.goto_buffer(int(chr(key)) - 1)
-            doc = bufs.docs[bufs.current]
-            doc.goto_logical_page(doc.logicalpage)
-            doc.set_layout(doc.papersize,adjustpage=False)
-            doc.mark_all_pages_stale()
-            if doc.citekey:
-                bar.message = doc.citekey
-            count_string = ""
-            stack = [0]
-
-        elif stack[0] in keys.BUFFER_CYCLE and key == ord('d'):
-            bufs.close_buffer(bufs.current)
-            doc = bufs.docs[bufs.current]
-            doc.goto_logical_page(doc.logicalpage)
-            doc.set_layout(doc.papersize,adjustpage=False)
-            doc.mark_all_pages_stale()
-            if doc.citekey:
-                bar.message = doc.citekey
-            count_string = ""
-            stack = [0]
-
-        elif stack[0] in keys.BUFFER_CYCLE and key in keys.BUFFER_CYCLE:
-            bufs.cycle(count)
-            doc = bufs.docs[bufs.current]
-            doc.goto_logical_page(doc.logicalpage)
-            doc.set_layout(doc.papersize,adjustpage=False)
-            doc.mark_all_pages_stale()
-            if doc.citekey:
-                bar.message = doc.citekey
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.BUFFER_CYCLE_REV:
-            bufs.cycle(-count)
-            doc = bufs.docs[bufs.current]
-            doc.goto_logical_page(doc.logicalpage)
-            doc.set_layout(doc.papersize,adjustpage=False)
-            doc.mark_all_pages_stale()
-            if doc.citekey:
-                bar.message = doc.citekey
-            count_string = ""
-            stack = [0]
-
-        elif key in range(48,58): #numerals
-            stack = [key] + stack
-            count_string = count_string + chr(key)
-
-        elif key in keys.QUIT:
-            clean_exit()
-
-        elif key in keys.GOTO_PAGE:
-            if count_string == "":
-                p = doc.page_to_logical(doc.pages)
-            else:
-                p = count
-            doc.goto_logical_page(p)
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.NEXT_PAGE:
-            doc.next_page(count)
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.PREV_PAGE:
-            doc.prev_page(count)
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.GO_BACK:
-            doc.goto_page(doc.prevpage)
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.NEXT_CHAP:
-            doc.next_chap(count)
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.PREV_CHAP:
-            doc.prev_chap(count)
-            count_string = ""
-            stack = [0]
-
-        elif stack[0] in keys.GOTO and key in keys.GOTO:
-            doc.goto_page(0)
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.ROTATE_CW:
-            doc.rotation = (doc.rotation + 90 * count) % 360
-            doc.mark_all_pages_stale()
-            count_string = ''
-            stack = [0]
-
-        elif key in keys.ROTATE_CCW:
-            doc.rotation = (doc.rotation - 90 * count) % 360
-            doc.mark_all_pages_stale()
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.TOGGLE_AUTOCROP:
-            # cycle through no crop, autocrop, and manualcrop
-            if doc.manualcroprect != [None,None]:
-                if doc.autocrop:
-                    doc.autocrop = False
-                    doc.manualcrop = True
-                elif doc.manualcrop:
-                    doc.autocrop = False
-                    doc.manualcrop = False
-                else:
-                    doc.autocrop = True
-            # just toggle autocrop
-            else:
-                doc.autocrop = not doc.autocrop
-            doc.mark_all_pages_stale()
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.TOGGLE_ALPHA:
-            doc.alpha = not doc.alpha
-            doc.mark_all_pages_stale()
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.TOGGLE_INVERT:
-            doc.invert = not doc.invert
-            doc.mark_all_pages_stale()
-            count_string = ""
-            stack = [0]
-        
-        elif key in keys.TOGGLE_TINT:
-            doc.tint = not doc.tint
-            doc.mark_all_pages_stale()
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.SHOW_TOC:
-            doc.show_toc(bar)
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.SHOW_META:
-            doc.show_meta(bar)
-            count_string = ""
-            stack = [0]
-        
-        elif key in keys.SHOW_LINKS:
-            doc.show_links(bar)
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.TOGGLE_TEXT_MODE:
-            doc.view_text()
-            count_string = ""
-            stack = [0]
-       
-        elif key in keys.INC_FONT:
-            doc.set_layout(doc.papersize - count)
-            doc.mark_all_pages_stale()
-            count_string = ""
-            stack = [0]
-        
-        elif key in keys.DEC_FONT:
-            doc.set_layout(doc.papersize + count)
-            doc.mark_all_pages_stale()
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.VISUAL_MODE:
-            visual_mode(doc,bar)
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.INSERT_NOTE:
-            text = doc.make_link()
-            doc.send_to_neovim(text,append=False)
-            count_string = ""
-            stack = [0]
-        
-        elif key in keys.APPEND_NOTE:
-            text = doc.make_link()
-            doc.send_to_neovim(text,append=True)
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.SET_PAGE_LABEL:
-            if doc.is_pdf:
-                doc.set_pagelabel(count,'arabic')
-            else:
-                doc.first_page_offset = count - doc.page
-            doc.pages_to_logical_pages()
-            count_string = ""
-            stack = [0]
-
-        elif key in keys.SET_PAGE_ALT:
-            if doc.is_pdf:
-                doc.set_pagelabel(count,'roman lowercase')
-            else:
-                doc.first_page_offset = count - doc.page
-            doc.pages_to_logical_pages()
-            count_string = ""
-        
-        elif key == ord('/'):
-            scr.place_string(1,scr.rows,"/")
-            curses.echo()
-            scr.set_cursor(2,scr.rows)
-            s = scr.stdscr.getstr()
-            search_text = s.decode('utf-8')
-            curses.noecho()
-            bar.message = doc.search_text(search_text)
-
-        elif key in keys.OPEN_GUI:
-            subprocess.run([config.GUI_VIEWER, doc.filename], check=True)
-
-        elif key in keys.DEBUG:
-            pass
-
-        elif key in range(48,257): #printable characters
-            stack = [key] + stack
+        # handle every key that is already queued before displaying
+        # the page again, so that holding down j displays only the
+        # page it ends up on
+        while key != -1:
+
+            count = pending_count if has_count else 1
+
+            if key == 27:
+                # a graphics reply that came too late for display_page
+                # arrives as keys; read past it, keeping real type-ahead
+                if not scr.skip_gr_reply():
+                    # quash stray escape codes
+                    scr.swallow_keys()
+                    reset()
+                    dirty_bar = True
+
+            # keys that mean something else after a prefix
+
+            elif stack[0] in keys.BUFFER_CYCLE and 48 <= key < 58:
+                bufs.goto_buffer(int(chr(key)) - 1)
+                switch_buffer()
+                dirty = True
+
+            elif stack[0] in keys.BUFFER_CYCLE and key in keys.BUFFER_CLOSE:
+                bufs.close_buffer(bufs.current)
+                switch_buffer()
+                dirty = True
+
+            elif stack[0] in keys.BUFFER_CYCLE and key in keys.BUFFER_CYCLE:
+                bufs.cycle(count)
+                switch_buffer()
+                dirty = True
+
+            elif stack[0] in keys.GOTO and key in keys.GOTO:
+                doc.goto_page(0)
+                reset()
+                dirty = True
+
+            elif 48 <= key < 58: #numerals
+                stack = [key] + stack
+                stack_str += chr(key)
+                pending_count = pending_count * 10 + (key - 48)
+                has_count = True
+                dirty_bar = True
+
+            elif key in dispatch:
+                dispatch[key]()
+                dirty = True
+
+            elif 48 <= key < 257: #printable characters
+                stack = [key] + stack
+                stack_str += chr(key)
+                dirty_bar = True
+
+            scr.stdscr.nodelay(True)
+            key = scr.stdscr.getch()
+            scr.stdscr.nodelay(False)
 
 
 # config is global